@@ -11,7 +11,7 @@ from datetime import datetime
 from sqlalchemy.orm import sessionmaker, create_session
 from sqlalchemy import (MetaData, create_engine, Table, Column,
                         Integer, Float, String, Text, DateTime,
-                        ForeignKey, UniqueConstraint)
+                        ForeignKey, UniqueConstraint, Index)
 
 from .utils import dumpsql, backup_versions
 
@@ -42,7 +42,7 @@ def NamedTable(tablename, metadata, keyid='id', nameid='name',
     return Table(tablename, metadata, *args)
 
 class InitialData:
-    info    = [["version", "1.2"],
+    info    = [["version", "1.4"],
                ["verify_erase", "1"],
                ["verify_move",   "1"],
                ["verify_overwrite",  "1"],
@@ -97,7 +97,10 @@ def  make_newdb(dbname, server= 'sqlite'):
                           Column('id', Integer, primary_key=True),
                           PointerCol('instrument'),
                           PointerCol('pv'),
-                          Column('display_order', Integer, default=0))
+                          Column('display_order', Integer, default=0),
+                          Column('move_order', Integer),
+                          Index('ix_instpv_inst_order',
+                                'instrument_id', 'display_order'))
 
 
     position_pv = Table('position_pv', metadata,
@@ -105,7 +108,8 @@ def  make_newdb(dbname, server= 'sqlite'):
                         StrCol('notes'),
                         PointerCol('position'),
                         PointerCol('pv'),
-                        StrCol('value'))
+                        StrCol('value'),
+                        Index('ix_pospv_posid', 'position_id'))
 
     info       = Table('info', metadata,
                        Column('key', Text, primary_key=True, unique=True),
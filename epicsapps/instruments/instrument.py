@@ -14,9 +14,11 @@ import json
 import epics
 import time
 import socket
+import threading
 
-from sqlalchemy import Row
+from sqlalchemy import MetaData, Index, Row, select, and_, text
 from .utils import backup_versions, save_backup, normalize_pvname, MOTOR_FIELDS
+from ..utils import get_rectype
 from .creator import make_newdb
 
 from .simpledb import (SimpleDB, isSimpleDB, get_credentials, isotime)
@@ -77,23 +79,37 @@ class InstrumentDB(SimpleDB):
         self.pvtype_names = {}
         self.pvtype_ids = {}
         self.restoring_pvs = []
+        self.restore_lock = threading.Lock()
+        self.restore_done = threading.Event()
+        self.restore_done.set()
+        self.hostname = socket.gethostname()
+        self.pid = str(os.getpid())
+        self._rtyp_cache = {}
+        self._rtyp_nsaved = 0
         SimpleDB.__init__(self, **self.conndict)
+        if self.engine is not None:
+            self.check_version()
+        self.load_rtyp_cache()
         self.connect_pvs()
 
     def connect_pvs(self):
-        for row in self.get_rows('pv'):
-            self.pvs[row.name] = epics.get_pv(row.name)
+        """create all PVs without waiting for connection, so that
+        channel searches are sent together, then poll once"""
+        rows = self.get_rows('pv')
+        for row in rows:
+            if row.name not in self.pvs:
+                self.pvs[row.name] = epics.get_pv(row.name, connect=False)
 
         self.map_pvtypes()
-        time.sleep(0.01)
-        for row in self.get_rows('pv'):
+        for row in rows:
             tname = self.pvtype_names.get(row.pvtype_id, 'other')
             if tname == 'other':
                 self.update('pv', where={'name': row.name}, pvtype_id=1)
             if tname == 'motor':
                 prefix = row.name.replace('.VAL', '')
                 for field in MOTOR_FIELDS:
-                    epics.get_pv(f'{prefix}{field}')
+                    epics.get_pv(f'{prefix}{field}', connect=False)
+        epics.ca.poll()
 
     def create_newdb(self, dbname, connect=False):
         "create a new, empty database"
@@ -103,25 +119,64 @@ class InstrumentDB(SimpleDB):
         if connect:
             time.sleep(0.5)
             self.connect(**self.conndict)
+            self.check_version()
 
     def check_version(self):
-        version_string = self.get_info('version')
-        if version_string < '1.2':
-            print('Upgrading Database to Version 1.2')
-            for statement in upgrades.sqlcode['1.2']:
-                self.session.execute(statement)
-            self.set_info('version', '1.2')
-
-        if version_string < '1.3':
-            print('Upgrading Database to Version 1.3')
-            for statement in upgrades.sqlcode['1.3']:
-                self.session.execute(statement)
-            self.set_info('version', '1.3')
-
+        """upgrade database schema to the current version, re-reading
+        the tables if any upgrade was applied"""
+        version_string = self.get_info('version', default='1.0')
+        if version_string >= upgrades.VERSIONS[-1]:
+            return
+        for version in upgrades.VERSIONS:
+            if version_string < version:
+                self.upgrade_schema(version)
+
+        self.metadata = MetaData()
+        self.metadata.reflect(bind=self.engine)
+        self.tables = self.metadata.tables
+
+    def upgrade_schema(self, version):
+        """upgrade database schema to a version, running all statements
+        for that version in one transaction on one connection"""
+        print(f'Upgrading Database to Version {version}')
+        set_version = self.set_info('version', version, do_execute=False)
+        with self.engine.begin() as conn:
+            if conn.dialect.name == 'sqlite':
+                # pysqlite does not begin a transaction before DDL
+                conn.exec_driver_sql('begin')
+            for statement in upgrades.sqlcode.get(version, []):
+                conn.execute(text(statement))
+            for name, tablename, columns in upgrades.indexes.get(version, []):
+                tab = self.tables[tablename]
+                Index(name, *[tab.c[col] for col in columns]).create(
+                    conn, checkfirst=True)
+            conn.execute(set_version)
+
+    def load_rtyp_cache(self):
+        """load cached record types for PVs, saved in the info table"""
+        val = self.get_info('pv_rtyp_cache', default='{}')
+        try:
+            self._rtyp_cache = json.loads(val)
+        except (TypeError, ValueError):
+            self._rtyp_cache = {}
+        self._rtyp_nsaved = len(self._rtyp_cache)
+
+    def save_rtyp_cache(self):
+        """save cached record types for PVs to the info table,
+        if any new record types have been looked up"""
+        if len(self._rtyp_cache) != self._rtyp_nsaved:
+            self.set_info('pv_rtyp_cache', json.dumps(self._rtyp_cache))
+            self._rtyp_nsaved = len(self._rtyp_cache)
+
+    def close(self):
+        "close session"
+        self.save_rtyp_cache()
+        SimpleDB.close(self)
 
     def commit(self):
         "commit session state"
-        self.set_info('modify_date', isotime())
+        self.save_rtyp_cache()
+        self.set_info('modify_date', isotime(timespec='seconds'))
         return self.session.commit()
 
     def query(self, *args, **kws):
@@ -132,7 +187,7 @@ class InstrumentDB(SimpleDB):
         """set hostname and process ID, as on intial set up"""
         name, pid = '', '0'
         if not clear:
-            name, pid = socket.gethostname(), str(os.getpid())
+            name, pid = self.hostname, self.pid
         self.set_info('host_name', name)
         self.set_info('process_id', pid)
 
@@ -141,8 +196,8 @@ class InstrumentDB(SimpleDB):
         db_host_name = self.get_info('host_name', default='')
         db_process_id  = self.get_info('process_id', default='0')
         return ((db_host_name == '' and db_process_id == '0') or
-                (db_host_name == socket.gethostname() and
-                 db_process_id == str(os.getpid())))
+                (db_host_name == self.hostname and
+                 db_process_id == self.pid))
 
     def set_config(self, name, notes):
         """set configuration data (name / notes)
@@ -173,19 +228,24 @@ class InstrumentDB(SimpleDB):
     def get_instrument_pvs(self, instname):
         """get dict of {pvname: (pv_id, epics_pv} ordered by
         'display_order' for an instrument"""
-        inst = self.get_instrument(instname)
+        itab = self.tables['instrument']
+        pvtab = self.tables['pv']
+        instpv = self.tables['instrument_pv']
+        query = select(pvtab.c.name, instpv.c.pv_id).select_from(
+            instpv.join(itab, itab.c.id==instpv.c.instrument_id).join(
+                pvtab, pvtab.c.id==instpv.c.pv_id)).where(
+                    itab.c.name==instname).order_by(instpv.c.display_order)
+
         instpvs = {}
-        allpvs = self.get_allpvs()
-        for row in self.get_rows('instrument_pv',
-                                 where={'instrument_id':inst.id},
-                                 order_by='display_order'):
-            pvname = allpvs[row.pv_id]
-            instpvs[pvname] = (row.pv_id, self.pvs[pvname])
+        for row in self.execute(query).fetchall():
+            instpvs[row.name] = (row.pv_id, self.pvs[row.name])
         return instpvs
 
     def map_pvtypes(self):
-        self.pvtype_ids   = {t.name: t.id for t in self.get_rows('pvtype')}
-        self.pvtype_names = {t.id: t.name for t in self.get_rows('pvtype')}
+        """build {name: id} and {id: name} maps of pvtypes"""
+        rows = self.get_rows('pvtype')
+        self.pvtype_ids   = {t.name: t.id for t in rows}
+        self.pvtype_names = {t.id: t.name for t in rows}
 
     def get_pvtypes(self, pvobj):
         """create tuple of choices for PV Type for database,
@@ -203,18 +263,16 @@ class InstrumentDB(SimpleDB):
             typename = pvobj.type
             if '.' in prefix:
                 prefix, suffix = prefix.split('.')
-            rectype = epics.caget(f"{prefix}.RTYP")
+            rectype = get_rectype(prefix, cache=self._rtyp_cache)
             if rectype == 'motor' and suffix in (None, 'VAL'):
                 typename = 'motor'
             if pvobj.type == 'char' and pvobj.count > 1:
                 typename = 'string'
 
         elif isinstance(pvobj, Row) and 'pvtype_id' in pvobj._fields:
-            if len(self.pvtype_ids) < 1:
+            if len(self.pvtype_names) < 1:
                 self.map_pvtypes()
-            for _name, _id in self.pvtype_ids.items():
-                if _id == pvobj.pvtype_id:
-                    typename = _name
+            typename = self.pvtype_names.get(pvobj.pvtype_id, None)
 
         choices = ('numeric', 'string')
         if typename == 'motor':
@@ -241,15 +299,26 @@ class InstrumentDB(SimpleDB):
             raise InstrumentDBException(f"PV '{name}' not found in database")
         if len(self.pvtype_ids) < 1:
             self.map_pvtypes()
-        if pvtype not in self.pvtype_ids:
-            self.add_row('pvtype', name=pvtype)
-            self.map_pvtypes()
-        if pvtype in self.pvtype_ids:
-            self.update('pv', where={'name': pvrow.name},
-                        pvtype_id=self.pvtype_ids[pvtype])
+        pvtype_id = self.pvtype_ids.get(pvtype, None)
+        if pvtype_id is None:
+            tab = self.tables['pvtype']
+            result = self.execute(tab.insert().values(name=pvtype),
+                                  set_modify_date=True)
+            pvtype_id = result.inserted_primary_key[0]
+            self.pvtype_ids[pvtype] = pvtype_id
+            self.pvtype_names[pvtype_id] = pvtype
+        self.update('pv', where={'name': pvrow.name}, pvtype_id=pvtype_id)
 
     def get_allpvs(self):
-        return {row.id: row.name for row in self.get_rows('pv')}
+        """return dict of {pv_id: pvname} for all PVs"""
+        pvtab = self.tables['pv']
+        query = select(pvtab.c.id, pvtab.c.name).execution_options(
+            yield_per=1000)
+        allpvs = {}
+        with self.get_session() as session:
+            for row in session.execute(query):
+                allpvs[row.id] = row.name
+        return allpvs
 
     def get_pv(self, name, add=False):
         """return pv by name
@@ -267,6 +336,28 @@ class InstrumentDB(SimpleDB):
             self.add_pv(norm_name)
         return row
 
+    def get_pvs_bulk(self, names):
+        """return dict of {name: pv row} for a list of PV names,
+        using a single query.  As with get_pv(), rows saved with
+        a non-normalized name are renamed.  Names not found in the
+        database will have a value of None
+        """
+        norm_names = {name: normalize_pvname(name) for name in names}
+        pvtab = self.tables['pv']
+        allnames = set(norm_names.values()) | set(str(n) for n in norm_names)
+        query = pvtab.select().where(pvtab.c.name.in_(allnames))
+        found = {row.name: row for row in self.execute(query).fetchall()}
+
+        out = {}
+        for name, norm_name in norm_names.items():
+            row = found.get(norm_name, None)
+            if row is None and norm_name != name:
+                row = found.get(name, None)
+                if row is not None:
+                    self.update('pv', where={'name': name}, name=norm_name)
+            out[name] = row
+        return out
+
     def rename_position(self, oldname, newname, instrument=None):
         """rename a position"""
         pos = self.get_position(oldname, instrument=instrument)
@@ -289,6 +380,13 @@ class InstrumentDB(SimpleDB):
         return self.get_rows('position', where=where,
                              limit_one=True, none_if_empty=True)
 
+    def _get_inst_position(self, name, inst):
+        """return position from name and an instrument row already
+        looked up, avoiding a second instrument query"""
+        return self.get_rows('position',
+                             where={'name': name, 'instrument_id': inst.id},
+                             limit_one=True, none_if_empty=True)
+
     def add_instrument(self, name, pvs=None, **kws):
         """add instrument  notes and attributes optional
         returns Instruments instance
@@ -303,7 +401,6 @@ class InstrumentDB(SimpleDB):
         inst = self.get_rows('instrument', where={'name': name}, limit_one=True)
         if pvs is not None:
             self.add_instrument_pvs(name, pvs)
-        self.connect_pvs()
         return inst
 
     def add_instrument_pvs(self, instname, pvlist):
@@ -311,10 +408,16 @@ class InstrumentDB(SimpleDB):
         if inst is None:
             raise InstrumentDBException(f"No Instrument '{name}' found")
         npvs = 1+len(self.get_instrument_pvs(instname))
+        pvrows = self.get_pvs_bulk(pvlist)
+        rows = []
         for i, pvname in enumerate(pvlist):
-            thispv = self.get_pv(pvname, add=True)
-            self.add_row('instrument_pv', instrument_id=inst.id,
-                         pv_id=thispv.id, display_order=(npvs+i))
+            thispv = pvrows[pvname]
+            if thispv is None:
+                self.add_pv(pvname)
+                thispv = self.get_pv(pvname)
+            rows.append({'instrument_id': inst.id, 'pv_id': thispv.id,
+                         'display_order': npvs+i})
+        self.insert_many('instrument_pv', rows)
         self.connect_pvs()
 
     def remove_instrument_pv(self, instname, pvname):
@@ -357,7 +460,7 @@ class InstrumentDB(SimpleDB):
             raise InstrumentDBException('Save Postion needs valid instrument')
 
         posname = posname.strip()
-        pos  = self.get_position(posname, instname)
+        pos  = self._get_inst_position(posname, inst)
         if pos is None:
             raise InstrumentDBException("Postion '%s' not found for '%s'" %
                                         (posname, instname))
@@ -371,9 +474,12 @@ class InstrumentDB(SimpleDB):
         if inst is None:
             raise InstrumentDBException('Save Postion needs valid instrument')
 
-        for pos in self.get_positions(instname):
-            self.remove_position(pos.name, instname)
-
+        ptab = self.tables['position']
+        pospv = self.tables['position_pv']
+        pos_ids = select(ptab.c.id).where(ptab.c.instrument_id==inst.id)
+        self.execute(pospv.delete().where(pospv.c.position_id.in_(pos_ids)),
+                     set_modify_date=True)
+        self.delete_rows('position_pv',   {'position_id': None})
         self.delete_rows('position',      {'instrument_id': inst.id})
         self.delete_rows('instrument_pv', {'instrument_id': inst.id})
         self.delete_rows('instrument', {'id': inst.id})
@@ -386,23 +492,19 @@ class InstrumentDB(SimpleDB):
             raise InstrumentDBException('Save Postion needs valid instrument')
 
         posname = posname.strip()
-        pos  = self.get_position(posname, instname)
+        pos  = self._get_inst_position(posname, inst)
+        kwargs = {}
+        if 'modify_time' in self.tables['position'].c:
+            kwargs['modify_time'] = isotime()
+
         if pos is None:
-            ptab = self.tables['position']
-            kwargs = {'name': posname,
-                   'instrument_id': inst.id, 'notes': notes}
-            if 'modify_time' in ptab.c:
-                kwargs['modify_time'] = isotime()
+            kwargs.update({'name': posname,
+                           'instrument_id': inst.id, 'notes': notes})
             self.add_row('position', **kwargs)
-            pos = self.get_position(posname, instname)
+            pos = self._get_inst_position(posname, inst)
 
         else:
             where = {'name': posname, 'instrument_id': inst.id}
-            kwargs = {}
-            ptab = self.tables['position']
-            if 'modify_time' in ptab.c:
-                kwargs['modify_time'] = isotime()
-
             if notes is not None:
                 kwargs['notes'] = notes
             self.update('position', where=where, **kwargs)
@@ -418,12 +520,11 @@ class InstrumentDB(SimpleDB):
         if len(missing_pvs) > 0:
             raise InstrumentDBException(f'Save Postion: missing pvs:\n {missing_pvs}')
 
-        for name, pvdat in instpvs.items():
-            pvid = pvdat[0]
-            value = values[name]
-            self.insert('position_pv', position_id=pos.id,
-                        pv_id=pvid, value=values[name],
-                        notes=f"'{inst.name}' / '{posname}'")
+        notes = f"'{inst.name}' / '{posname}'"
+        rows = [{'position_id': pos.id, 'pv_id': pvdat[0],
+                 'value': values[name], 'notes': notes}
+                for name, pvdat in instpvs.items()]
+        self.insert_many('position_pv', rows)
 
 
     def get_position_values(self, posname, instname, exclude_pvs=None):
@@ -436,7 +537,7 @@ class InstrumentDB(SimpleDB):
                 'restore_postion needs valid instrument')
 
         posname = posname.strip()
-        pos  = self.get_position(posname, instname)
+        pos  = self._get_inst_position(posname, inst)
         if pos is None:
             raise InstrumentDBException(
                 f"restore_postion  position '{posname}' not found")
@@ -444,49 +545,74 @@ class InstrumentDB(SimpleDB):
         if exclude_pvs is None:
             exclude_pvs = []
 
-        allpvs = self.get_allpvs()
-        pvvals = {}
-        for row in self.get_rows('position_pv', where={'position_id': pos.id}):
-            pvvals[row.pv_id] = row.value
+        pvtab = self.tables['pv']
+        instpv = self.tables['instrument_pv']
+        pospv = self.tables['position_pv']
+
+        # single query joining instrument_pv -> pv -> position_pv,
+        # ordered by display order.  If a PV has more than one saved
+        # value for this position, the most recent (largest id) wins
+        query = select(pvtab.c.name, pospv.c.value).select_from(
+            instpv.join(pvtab, pvtab.c.id==instpv.c.pv_id).outerjoin(
+                pospv, and_(pospv.c.pv_id==pvtab.c.id,
+                            pospv.c.position_id==pos.id))).where(
+                instpv.c.instrument_id==inst.id).order_by(
+                    instpv.c.display_order, pospv.c.id)
 
         # ordered_pvs will hold ordered list of pv, vals in "move order"
         ordered_pvs = {}
-        for row in self.get_rows('instrument_pv',
-                                 where={'instrument_id': inst.id},
-                                 order_by='display_order'):
-            ordered_pvs[allpvs[row.pv_id]] = pvvals.get(row.pv_id, None)
+        for row in self.execute(query).fetchall():
+            ordered_pvs[row.name] = row.value
         return ordered_pvs
 
 
-    def restore_position(self, posname, instname, exclude_pvs=None):
+    def restore_position(self, posname, instname, exclude_pvs=None,
+                         timeout=1.0):
         """
         restore named position for instrument
+
+        disconnected PVs are waited for together, for at most
+        `timeout` seconds in total, before the values are put.
         """
-        t0 = time.time()
         if exclude_pvs is None:
             exclude_pvs = []
         posdict = self.get_position_values(posname, instname,
                                            exclude_pvs=exclude_pvs)
 
-        self.restoring_pvs = []
-        for pvname, value in posdict.items():
-            # put values without waiting
-            if pvname in exclude_pvs:
-                continue
-            thispv = self.pvs[pvname]
-            if not thispv.connected:
-                thispv.wait_for_connection(timeout=1.0)
-            if thispv.connected:
-                try:
-                    thispv.put(value, wait=False, use_complete=True)
-                except:
-                    pass
-                self.restoring_pvs.append(thispv)
-
-    def restore_complete(self):
-        work_pvs = self.restoring_pvs[:]
-        self.restoring_pvs = []
-        for pv in work_pvs:
-            if not pv.put_complete:
-                self.restoring_pvs.append(pv)
-        return len(self.restoring_pvs) == 0
+        work = [(self.pvs[pvname], value) for pvname, value in posdict.items()
+                if pvname not in exclude_pvs]
+
+        expire = time.time() + timeout
+        while (time.time() < expire and
+               not all(thispv.connected for thispv, _ in work)):
+            epics.ca.poll(evt=1.e-3, iot=0.01)
+
+        work = [(thispv, value) for thispv, value in work if thispv.connected]
+        with self.restore_lock:
+            self.restoring_pvs = [thispv for thispv, _ in work]
+            self.restore_done.clear()
+            if len(work) == 0:
+                self.restore_done.set()
+
+        for thispv, value in work:
+            # put values without waiting, with callback on completion
+            try:
+                thispv.put(value, wait=False, use_complete=True,
+                           callback=self._onPutComplete)
+            except:
+                self._onPutComplete(pvname=thispv.pvname)
+
+    def _onPutComplete(self, pvname=None, **kws):
+        "put callback: remove PV from list, signal when all are done"
+        with self.restore_lock:
+            self.restoring_pvs = [pv for pv in self.restoring_pvs
+                                  if pv.pvname != pvname]
+            if len(self.restoring_pvs) == 0:
+                self.restore_done.set()
+
+    def restore_complete(self, timeout=None):
+        """return whether the last restore_position() has completed,
+        optionally waiting up to `timeout` seconds for completion"""
+        if timeout is None:
+            return self.restore_done.is_set()
+        return self.restore_done.wait(timeout)
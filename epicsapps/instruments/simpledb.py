@@ -25,10 +25,14 @@ server: postgresql
 port:  5432
 user:  db_user_name
 password: db_user_password
+
+    Optional keys 'pool_size', 'max_overflow', and 'pool_recycle'
+    set the connection pool for postgresql and mysql servers.
     """
     conn = {'dbname': 'escandb', 'server': 'postgresql',
             'host': 'localhost',  'port': 5432,
-            'user': '', 'password': '_invalid_password_'}
+            'user': '', 'password': '_invalid_password_',
+            'pool_size': 10, 'max_overflow': 10, 'pool_recycle': 1800}
     if credfile is None:
         credfile = os.environ.get(envvar, None)
     if credfile is not None and os.path.exists(credfile):
@@ -55,10 +59,10 @@ def json_encode(val):
         return val
     return  json.dumps(val)
 
-def isotime(dtime=None, sep=' '):
+def isotime(dtime=None, sep=' ', timespec='auto'):
     if dtime is None:
         dtime = datetime.now()
-    return datetime.isoformat(dtime, sep=sep)
+    return dtime.isoformat(sep=sep, timespec=timespec)
 
 def isSimpleDB(dbname, required_tables=('info',)):
     """test if a file is a valid sqlite3 SimpleDB file
@@ -105,17 +109,26 @@ class SimpleDB(object):
 
     """
     def __init__(self, dbname=None, server='postgresql', user='',
-                 password='',  host='', port=5432, dialect=None, logfile=None):
+                 password='',  host='', port=5432, dialect=None, logfile=None,
+                 pool_size=10, max_overflow=10, pool_recycle=1800):
         self.engine = None
         self.metadata = None
         self.logfile = logfile
         if dbname is not None:
             self.connect(dbname, server=server, user=user,
-                         password=password, port=port, host=host, dialect=dialect)
+                         password=password, port=port, host=host,
+                         dialect=dialect, pool_size=pool_size,
+                         max_overflow=max_overflow, pool_recycle=pool_recycle)
 
     def connect(self, dbname, server='postgresql', user='',
-                password='', port=None, host='localhost', dialect=None):
-        "connect to an existing database"
+                password='', port=None, host='localhost', dialect=None,
+                pool_size=10, max_overflow=10, pool_recycle=1800):
+        """connect to an existing database
+
+        for postgresql and mysql, a pool of connections is kept, with
+        pool_size, max_overflow, and pool_recycle (in seconds) passed
+        to create_engine(), and connections are checked before use.
+        """
 
         self.dbname = dbname
         if port not in (None, 'None', ''):
@@ -124,6 +137,10 @@ class SimpleDB(object):
             except:
                 pass
         connect_args = {}
+        engine_args = {'pool_size': int(pool_size),
+                       'max_overflow': int(max_overflow),
+                       'pool_recycle': int(pool_recycle),
+                       'pool_pre_ping': True}
         if server.startswith('post') or server.startswith('pg'):
             server ='postgresql'
             if port is None:
@@ -136,6 +153,7 @@ class SimpleDB(object):
             connect_str= f'{user}:{password}@{host}:{port:d}/{dbname}'
         else:
             server = 'sqlite'
+            engine_args = {}
             connect_str = f'/{dbname}'
             connect_args = {'check_same_thread': False}
 
@@ -144,7 +162,8 @@ class SimpleDB(object):
         else:
             connect_str = f'{server}+{dialect}://{connect_str}'
 
-        self.engine = create_engine(connect_str, connect_args=connect_args)
+        self.engine = create_engine(connect_str, connect_args=connect_args,
+                                    **engine_args)
         self.metadata = MetaData()
         try:
             self.metadata.reflect(bind=self.engine)
@@ -167,14 +186,17 @@ class SimpleDB(object):
         with Session(self.engine) as session, session.begin():
             session.flush()
 
-    def execute(self, query, set_modify_date=False):
+    def execute(self, query, params=None, set_modify_date=False):
         """
         general execute of query, optionally setting 'modify date'
         and committing
+
+        params can be a list of dicts to execute the query for
+        many rows in a single transaction ("executemany")
         """
         result = None
         with Session(self.engine) as session, session.begin():
-            result = session.execute(query)
+            result = session.execute(query, params)
             if set_modify_date:
                 q = self.set_info('modify_date', isotime(), do_execute=False)
                 if q is not None:
@@ -266,6 +288,16 @@ class SimpleDB(object):
         tab = self.tables[tablename]
         self.execute(tab.insert().values(**kws), set_modify_date=True)
 
+    def insert_many(self, tablename, rows):
+        """insert many rows to a table in a single transaction
+
+        rows is a list of dicts of keyword/value pairs for each row
+        """
+        if len(rows) < 1:
+            return
+        tab = self.tables[tablename]
+        self.execute(tab.insert(), params=rows, set_modify_date=True)
+
     def table_error(self, message, tablename, funcname):
         raise ValueError(f"{message} for table '{tablename}' in {funcname}()")
 
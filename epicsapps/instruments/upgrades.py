@@ -5,9 +5,9 @@ sqlcode = {}
 
 # version 1.2 --
 #  makes position (name, instrument_id) unique
+#  all statements for a version are run in a single transaction
 
 sqlcode['1.2'] = [
-    "begin transaction",
     """create temporary table position_backup(
     id INTEGER NOT NULL,  name TEXT NOT NULL,
     notes TEXT, attributes TEXT, date DATETIME,
@@ -31,3 +31,15 @@ sqlcode['1.2'] = [
 sqlcode['1.3'] = ["alter table instrument_pv add column move_order integer;",
                   "update instrument_pv set move_order=1;",
                   ]
+
+# version 1.4 adds indexes for the lookups of PVs for an instrument
+# (ordered by display order) and of values for a position.  These are
+# given as (name, table, columns) so that the DDL is made for the
+# database dialect, and indexes that already exist are skipped.
+sqlcode['1.4'] = []
+indexes = {}
+indexes['1.4'] = [('ix_instpv_inst_order', 'instrument_pv',
+                   ('instrument_id', 'display_order')),
+                  ('ix_pospv_posid', 'position_pv', ('position_id',))]
+
+VERSIONS = ('1.2', '1.3', '1.4')
@@ -42,15 +42,11 @@ def backup_versions(fname, max=5):
     for i in range(max-1, 0, -1):
         fb0 = "%s_%i%s" % (base, i, ext)
         fb1 = "%s_%i%s" % (base, i+1, ext)
-        if os.path.exists(fb0):
-            try:
-                shutil.move(fb0, fb1)
-            except:
-                pass
-    try:
-        shutil.move(fname, "%s_1%s" % (base, ext))
-    except:
-        pass
+        try:
+            os.replace(fb0, fb1)
+        except FileNotFoundError:
+            pass
+    os.replace(fname, "%s_1%s" % (base, ext))
 
 
 def save_backup(fname, outfile=None):
@@ -38,6 +38,12 @@ class Fly2Camera(object):
         self.cam.connect(self.busman.getCameraFromIndex(camera_id))
         self.info = self.cam.getCameraInfo()
 
+    def SetLatestImageOnly(self):
+        """set grab mode to keep only the most recent image, so that
+        retrieveBuffer() does not return stale, buffered images.
+        must be called before StartCapture()"""
+        self.cam.setConfiguration(grabMode=PyCapture2.GRAB_MODE.DROP_FRAMES)
+
     def StartCapture(self):
         """"""
         self.cam.startCapture()
@@ -51,6 +57,10 @@ class Fly2Camera(object):
             return None
         return self.cam.getProperty(PYCAP2_PROPERTIES[name])
 
+    def GetProperties(self, names):
+        """return dict of {name: property} for a list of property names"""
+        return {name: self.GetProperty(name) for name in names}
+
     def GetPropertyDict(self, name):
         p = self.getProperty(name)
         return {"type": p.type,
@@ -3,9 +3,12 @@
 """
 import numpy as np
 import wx
+import wx.lib.newevent
 import time
 import os
 from functools import partial
+from threading import Thread, Condition, Event
+from queue import Queue
 from epics import PV, Device, caput, poll
 from epics.wx import DelayedEpicsCallback, EpicsFunction
 
@@ -15,6 +18,15 @@ from .imagepanel_base import ImagePanel_Base, ConfPanel_Base
 
 LEFT = wx.ALIGN_LEFT|wx.EXPAND
 
+# camera properties with a single value, and all properties shown
+SCALAR_PROPS = ('shutter', 'gain', 'gamma') # , 'brightness')
+SCALAR_SET = frozenset(SCALAR_PROPS)
+ALL_PROPS = SCALAR_PROPS + ('white_balance',)
+WB_WIDGETS = frozenset(('wb_red', 'wb_blue', 'wb_auto'))
+
+# sent from image panel to conf panel to poll camera properties
+PropertyPollEvent, EVT_PROPERTY_POLL = wx.lib.newevent.NewEvent()
+
 HAS_FLY2 = False
 try:
     import PyCapture2
@@ -26,7 +38,8 @@ except ImportError:
 class ImagePanel_Fly2(ImagePanel_Base):
     """Image Panel for FlyCapture2 camera"""
     def __init__(self, parent,  camera_id=0, writer=None,
-                 autosave_file=None, output_pv=None, **kws):
+                 autosave_file=None, output_pv=None, poll_interval_ms=1000,
+                 **kws):
         if not HAS_FLY2:
             raise ValueError("PyCapture2 library not available")
         super(ImagePanel_Fly2, self).__init__(parent, -1,
@@ -41,22 +54,45 @@ class ImagePanel_Fly2(ImagePanel_Base):
         self.img_h = 600.5
         self.writer = writer
         self.cam_name = '-'
+        self.cam_info = None
+        self.img_size = None
         self.confpanel = None
-        self.timer = wx.Timer(self)
-        self.Bind(wx.EVT_TIMER, self.onTimer, self.timer)
+        self.frame = None
+        self.frame_count = 0
+        self.frame_cond = Condition()
+        self.grab_running = Event()
+        self.grab_thread = None
+        self.refresh_pending = False
+        self.poll_interval_ms = poll_interval_ms
+        self.last_poll = 0.0
 
     def Start(self):
         "turn camera on"
         self.camera.Connect()
-        self.cam_name = self.camera.info.modelName
+        # camera info and image size do not change: read them only once
+        if self.cam_info is None:
+            self.cam_info = self.camera.info
+        self.cam_name = self.cam_info.modelName
+        try:
+            self.camera.SetLatestImageOnly()
+        except PyCapture2.Fc2error:
+            pass
 
         try:
             self.camera.StartCapture()
-            width, height = self.camera.GetSize()
-            self.img_w = float(width+0.5)
-            self.img_h = float(height+0.5)
-        except:
-            pass
+        except PyCapture2.Fc2error as err:
+            if self.writer is not None:
+                self.writer("Fly2 camera: could not start capture: %s" % err)
+            return
+        try:
+            if self.img_size is None:
+                self.img_size = self.camera.GetSize()
+        except PyCapture2.Fc2error as err:
+            # image size will be taken from the first grabbed frame
+            if self.writer is not None:
+                self.writer("Fly2 camera: could not read image size: %s" % err)
+        if self.img_size is not None:
+            self.set_img_size(*self.img_size)
         if self.output_pv is not None:
             for attr  in ('ArraySize0_RBV', 'ArraySize1_RBV', 'ArraySize2_RBV',
                           'ColorMode_RBV', 'ArrayData'):
@@ -68,12 +104,71 @@ class ImagePanel_Fly2(ImagePanel_Base):
             self.output_pvs['ArraySize1_RBV'].put(int(self.img_h))
             self.output_pvs['ArraySize0_RBV'].put(int(self.img_w))
 
-        self.timer.Start(50)
+        if self.grab_thread is not None:
+            # let a grab thread left from Stop() finish, now that
+            # capture has restarted.  If it is still running, it
+            # carries on as the only grab thread.
+            self.grab_thread.join(timeout=1.0)
+        self.grab_running.set()
+        if self.grab_thread is None or not self.grab_thread.is_alive():
+            self.grab_thread = Thread(target=self.grab_loop, daemon=True)
+            self.grab_thread.start()
 
     def Stop(self):
         "turn camera off"
-        self.timer.Stop()
+        self.grab_running.clear()
         self.camera.StopCapture()
+        if self.grab_thread is not None:
+            self.grab_thread.join(timeout=1.0)
+            if not self.grab_thread.is_alive():
+                self.grab_thread = None
+
+    def set_img_size(self, width, height):
+        self.img_size = (width, height)
+        self.img_w = width + 0.5
+        self.img_h = height + 0.5
+
+    def grab_loop(self):
+        """grab frames as the camera delivers them (run in a thread),
+        asking the GUI to redraw when a new frame arrives.  This is the
+        only reader of camera images while running: display, publishing
+        and GrabNumpyImage all use the frames it grabs"""
+        reported = False
+        while self.grab_running.is_set():
+            try:
+                img = self.camera.cam.retrieveBuffer()
+            except PyCapture2.Fc2error as err:
+                # report once, until frames are delivered again, but
+                # not the error from StopCapture() while stopping
+                if (not reported and self.writer is not None and
+                    self.grab_running.is_set()):
+                    wx.CallAfter(self.writer, "Fly2 camera: could not grab image: %s" % err)
+                reported = True
+                time.sleep(0.025)
+                continue
+            reported = False
+            img = img.convert(PyCapture2.PIXEL_FORMAT.RGB)
+            nrows, ncols = img.getRows(), img.getCols()
+            data = np.array(img.getData()).reshape((nrows, ncols, 3))
+            with self.frame_cond:
+                self.frame = (nrows, ncols, data)
+                self.frame_count += 1
+                self.frame_cond.notify_all()
+            if not self.refresh_pending:
+                self.refresh_pending = True
+                wx.CallAfter(self.onNewFrame)
+
+    def onNewFrame(self):
+        self.refresh_pending = False
+        if not self:
+            return
+        self.Refresh()
+        # ask conf panel to poll properties, instead of it using a timer
+        now = time.time()
+        if (self.confpanel is not None and
+            (now - self.last_poll) > self.poll_interval_ms/1000.0):
+            self.last_poll = now
+            wx.PostEvent(self.confpanel, PropertyPollEvent())
 
     def CaptureVideo(self, filename='Capture', format='MJPG', runtime=10.0):
         print(" in Capture Video!! ", runtime, filename)
@@ -109,66 +204,99 @@ class ImagePanel_Fly2(ImagePanel_Base):
         self.Stop()
         self.Start()
 
-    def SetExposureTime(self, exptime):
+    def set_exposure(self, exptime):
+        """set exposure time, returning dict of values written"""
         self.camera.SetPropertyValue('shutter', exptime, auto=False)
-        if self.confpanel is not None:
-            self.confpanel.wids['shutter'].SetValue(exptime)
-            self.confpanel.wids['shutter_auto'].SetValue(0)
+        return {'shutter': exptime}
 
-    def AutoSetExposureTime(self):
-        """auto set exposure time"""
+    def SetExposureTime(self, exptime):
+        "set exposure time, through the conf panel camera queue if shown"
+        if self.confpanel is None:
+            self.set_exposure(exptime)
+            return
+        self.confpanel.cam_queue.put((self.set_exposure, (exptime,),
+                                      self.confpanel.onExposureSet))
+
+    def auto_exposure(self, done=None):
+        """adjust exposure time and gain for image intensity, returning
+        dict of values written, and setting the done event when finished
+        -- run in conf panel cam_worker thread if shown"""
         count, IMAX = 0, 255.0
-        self.confpanel.wids['gain_auto'].SetValue(0)
-        while count < 5:
-            count += 1
-            img = self.GrabNumpyImage()
-            imgmax = img.max()
-            imgave = img.mean()
-            pgain = self.camera.GetProperty('gain').absValue
-            atime = self.camera.GetProperty('shutter').absValue
-            # print(" autoexposure ", count, imgmax, imgave, pgain, atime)
-            if imgmax > 250:
-                if  pgain > 4.0:
-                    pgain = 0.75 * pgain
-                    self.camera.SetPropertyValue('gain', pgain, auto=False)
-                    self.confpanel.wids['gain'].SetValue(pgain)
-                else:
-                    self.SetExposureTime(0.75*atime)
-            elif imgave < 100:
-                if atime > 60:
-                    pgain = 1.75 * pgain
-                    self.camera.SetPropertyValue('gain', pgain, auto=False)
-                    self.confpanel.wids['gain'].SetValue(pgain)
+        written = {}
+        try:
+            while count < 5:
+                count += 1
+                img = self.GrabNumpyImage()
+                imgmax = img.max()
+                imgave = img.mean()
+                pgain = self.camera.GetProperty('gain').absValue
+                atime = self.camera.GetProperty('shutter').absValue
+                # print(" autoexposure ", count, imgmax, imgave, pgain, atime)
+                if imgmax > 250:
+                    if  pgain > 4.0:
+                        pgain = 0.75 * pgain
+                        self.camera.SetPropertyValue('gain', pgain, auto=False)
+                        written['gain'] = pgain
+                    else:
+                        written.update(self.set_exposure(0.75*atime))
+                elif imgave < 100:
+                    if atime > 60:
+                        pgain = 1.75 * pgain
+                        self.camera.SetPropertyValue('gain', pgain, auto=False)
+                        written['gain'] = pgain
+                    else:
+                        etime = max(10, min(64, 1.75*atime))
+                        written.update(self.set_exposure(etime))
                 else:
-                    etime = max(10, min(64, 1.75*atime))
-                    self.SetExposureTime(etime)
-            else:
-                break
-            time.sleep(0.1)
+                    break
+                time.sleep(0.1)
+        finally:
+            if done is not None:
+                done.set()
+        return written
+
+    def AutoSetExposureTime(self):
+        """auto set exposure time, waiting for it to finish"""
+        if self.confpanel is None:
+            self.auto_exposure()
+            return
+        wx.CallAfter(self.confpanel.wids['gain_auto'].SetValue, 0)
+        done = Event()
+        self.confpanel.cam_queue.put((self.auto_exposure, (done,),
+                                      self.confpanel.onExposureSet))
+        done.wait(timeout=10.0)
 
     def GrabWxImage(self, scale=1, rgb=True, can_skip=True,
                     quality=wx.IMAGE_QUALITY_HIGH):
-        # print("Fly Grab Wx ", PyCapture2 )
-        try:
-            img = self.camera.cam.retrieveBuffer()
-        except PyCapture2.Fc2error:
-            time.sleep(0.025)
-            img = self.camera.cam.retrieveBuffer()
-
-        nrows = img.getRows()
-        ncols = img.getCols()
+        "return latest frame from grab_loop as wx Image"
+        with self.frame_cond:
+            frame = self.frame
+        if frame is None:
+            return None
+        nrows, ncols, data = frame
+        if self.img_size is None:
+            self.set_img_size(ncols, nrows)
         scale = max(scale, 0.05)
         width, height = int(scale*ncols), int(scale*nrows)
-        if rgb:
-            img = img.convert(PyCapture2.PIXEL_FORMAT.RGB)
-        # print("Fly Grab Wx ", img, nrows, ncols)
         self.data_shape = (nrows, ncols, 3)
-        self.data = np.array(img.getData())
+        self.data = data
         self.full_image = wx.Image(ncols, nrows, self.data)
         return self.full_image.Rescale(width, height, quality=quality)
 
-    def GrabNumpyImage(self):
-        return self.camera.GrabNumPyImage(format='rgb')
+    def GrabNumpyImage(self, timeout=1.0):
+        """return next frame from grab_loop as numpy array,
+        or grab one if not running"""
+        if not self.grab_running.is_set():
+            return self.camera.GrabNumPyImage(format='rgb')
+        with self.frame_cond:
+            count = self.frame_count
+            self.frame_cond.wait_for(lambda: self.frame_count > count,
+                                     timeout=timeout)
+            frame = self.frame
+        if frame is None:
+            return self.camera.GrabNumPyImage(format='rgb')
+        nrows, ncols, data = frame
+        return data.reshape((ncols, nrows, 3))
 
 class ConfPanel_Fly2(ConfPanel_Base):
     def __init__(self, parent, image_panel=None, camera_id=0,
@@ -178,6 +306,8 @@ class ConfPanel_Fly2(ConfPanel_Base):
         self.image_panel = image_panel
         self.camera_id = camera_id
         self.camera = self.image_panel.camera
+        self.last_written = {}
+        self.auto_props = {}
 
         wids = self.wids
         sizer = self.sizer
@@ -213,7 +343,8 @@ class ConfPanel_Fly2(ConfPanel_Base):
             akey = '%s_auto' % key
             wids[akey] =  wx.CheckBox(self, -1, label='auto')
             wids[akey].SetValue(0)
-            wids[akey].Bind(wx.EVT_CHECKBOX, partial(self.onAuto, prop=key))
+            wids[akey].Bind(wx.EVT_CHECKBOX, self.onAuto)
+            self.auto_props[wids[akey].GetId()] = key
             sizer.Add(wids[akey], (i, 2), (1, 1), LEFT)
             i = i + 1
 
@@ -232,7 +363,8 @@ class ConfPanel_Fly2(ConfPanel_Base):
                 akey = 'wb_auto'
                 wids[akey] =  wx.CheckBox(self, -1, label='auto')
                 wids[akey].SetValue(0)
-                wids[akey].Bind(wx.EVT_CHECKBOX, partial(self.onAuto, prop=key))
+                wids[akey].Bind(wx.EVT_CHECKBOX, self.onAuto)
+                self.auto_props[wids[akey].GetId()] = 'white_balance'
                 sizer.Add(wids[akey], (i, 2), (1, 1), LEFT)
             i += 1
 
@@ -252,82 +384,164 @@ class ConfPanel_Fly2(ConfPanel_Base):
 
         pack(self, sizer)
         self.__initializing = False
-        self.timer = wx.Timer(self)
-        self.Bind(wx.EVT_TIMER, self.onTimer, self.timer)
+        self.Bind(EVT_PROPERTY_POLL, self.onTimer)
+        self.cam_queue = Queue()
+        self.cam_thread = Thread(target=self.cam_worker, daemon=True)
+        self.cam_thread.start()
         wx.CallAfter(self.onConnect)
 
+    def cam_worker(self):
+        """run camera calls put in cam_queue as (func, args, callback),
+        in a thread, sending results to callback in the GUI thread.
+
+        While this panel is shown, camera properties are read and written
+        only here.  Images are read by the image panel grab thread."""
+        while True:
+            func, args, callback = self.cam_queue.get()
+            try:
+                result = func(*args)
+            except Exception as err:
+                writer = self.image_panel.writer
+                if writer is not None:
+                    wx.CallAfter(writer, "Fly2 camera error: %s" % err)
+                continue
+            if callback is not None:
+                wx.CallAfter(callback, result)
+
+    def read_props(self, names=ALL_PROPS):
+        """read camera info and properties, returning (info, props), with
+        props None if they could not be read -- run in cam_worker thread"""
+        cinfo = self.image_panel.cam_info
+        if cinfo is None:
+            cinfo = self.camera.info
+        try:
+            props = self.camera.GetProperties(names)
+        except PyCapture2.Fc2error:
+            props = None
+        return cinfo, props
+
     def onConnect(self, **kws):
-        for prop in ('shutter', 'gain', 'gamma'): # , 'brightness'):
-            p = self.camera.GetProperty(prop)
-            self.wids[prop].SetValue(p.absValue)
+        self.cam_queue.put((self.read_props, (), self.onPropsConnected))
+
+    def onPropsConnected(self, result):
+        "show camera info and property values read for onConnect"
+        cinfo, props = result
+        self.title.SetLabel("Camera Model: %s" % (cinfo.modelName))
+        self.title2.SetLabel("Serial #%d, Firmware %s" % (cinfo.serialNumber, cinfo.firmwareVersion))
+        if props is None:
+            if self.image_panel.writer is not None:
+                self.image_panel.writer("Fly2 camera: could not read camera properties")
+            return
+        for prop in SCALAR_PROPS:
+            p = props[prop]
+            self.wids[prop].SetValue(p.absValue, act=False)
             akey = '%s_auto' % prop
             self.wids[akey].SetValue({False: 0, True: 1}[p.autoManualMode])
 
-        p = self.camera.GetProperty('white_balance')
-        self.wids['wb_red'].SetValue(p.valueA)
-        self.wids['wb_blue'].SetValue(p.valueB)
+        p = props['white_balance']
+        self.wids['wb_red'].SetValue(p.valueA, act=False)
+        self.wids['wb_blue'].SetValue(p.valueB, act=False)
         self.wids['wb_auto'].SetValue({False: 0, True: 1}[p.autoManualMode])
-        self.timer.Start(1000)
-        cinfo  = self.image_panel.camera.info
-        self.title.SetLabel("Camera Model: %s" % (cinfo.modelName))
-        self.title2.SetLabel("Serial #%d, Firmware %s" % (cinfo.serialNumber, cinfo.firmwareVersion))
 
     def onEnableDataPush(self, evt=None, **kws):
         self.image_panel.datapush = evt.IsChecked()
 
     def onTimer(self, evt=None, **kws):
-        for prop in ('shutter', 'gain', 'gamma', 'white_balance'):
-            try:
-                p = self.camera.GetProperty(prop)
-            except:
-                return
+        # only properties in auto mode can change: skip reading others
+        active = []
+        for prop in ALL_PROPS:
+            akey = 'wb_auto' if prop == 'white_balance' else '%s_auto' % prop
+            if self.wids[akey].GetValue():
+                active.append(prop)
+        # skip if earlier camera calls are still waiting
+        if len(active) == 0 or not self.cam_queue.empty():
+            return
+        self.cam_queue.put((self.camera.GetProperties, (active,),
+                            self.onPropsRead))
+
+    def onPropsRead(self, props):
+        "show property values read in onTimer"
+        for prop, p in props.items():
             if p.autoManualMode:
+                # camera is changing this value: forget last value written,
+                # and show the new value without acting on it
+                self.last_written.pop(prop, None)
                 if  prop == 'white_balance':
-                    self.wids['wb_red'].SetValue(p.valueA)
-                    self.wids['wb_blue'].SetValue(p.valueB)
+                    self.wids['wb_red'].SetValue(p.valueA, act=False)
+                    self.wids['wb_blue'].SetValue(p.valueB, act=False)
                 else:
-                    self.wids[prop].SetValue(p.absValue)
+                    self.wids[prop].SetValue(p.absValue, act=False)
 
-    def onAuto(self, evt=None, prop=None, **kws):
+    def onAuto(self, evt=None, **kws):
         if not evt.IsChecked():
             return
-        if prop in ('wb_red', 'wb_blue', 'wb_auto'):
-            prop = 'white_balance'
-        try:
-            if prop in ('shutter', 'gain', 'gamma'): # , 'brightness'):
-                p = self.camera.GetProperty(prop)
-                self.camera.SetPropertyValue(prop, p.absValue, auto=True)
-                time.sleep(0.5)
-                p = self.camera.GetProperty(prop)
-                self.wids[prop].SetValue(p.absValue)
-            elif prop == 'white_balance':
-                red =  self.wids['wb_red'].GetValue()
-                blue = self.wids['wb_blue'].GetValue()
-                self.camera.SetPropertyValue(prop, (red, blue), auto=True)
-                time.sleep(0.5)
-                p = self.camera.GetProperty(prop)
-                self.wids['wb_red'].SetValue(p.valueA)
-                self.wids['wb_blue'].SetValue(p.valueB)
-        except:
-            return
+        prop = self.auto_props[evt.GetId()]
+        self.last_written.pop(prop, None)
+        value = None
+        if prop == 'white_balance':
+            value = (self.wids['wb_red'].GetValue(),
+                     self.wids['wb_blue'].GetValue())
+        self.cam_queue.put((self.set_auto, (prop, value), self.onAutoSet))
+
+    def set_auto(self, prop, value=None):
+        """set property to auto mode, and return (prop, property) after
+        letting it settle -- run in cam_worker thread"""
+        if value is None:
+            value = self.camera.GetProperty(prop).absValue
+        self.camera.SetPropertyValue(prop, value, auto=True)
+        time.sleep(0.5)
+        return prop, self.camera.GetProperty(prop)
+
+    def onAutoSet(self, result):
+        "show property values after set_auto"
+        prop, p = result
+        if prop == 'white_balance':
+            self.wids['wb_red'].SetValue(p.valueA, act=False)
+            self.wids['wb_blue'].SetValue(p.valueB, act=False)
+        else:
+            self.wids[prop].SetValue(p.absValue, act=False)
+
+    def onExposureSet(self, written):
+        """show exposure time and gain written by the image panel,
+        replacing the last values written from this panel"""
+        for prop, value in written.items():
+            self.wids[prop].SetValue(value, act=False)
+            self.wids['%s_auto' % prop].SetValue(0)
+            self.last_written[prop] = (round(float(value), 3), False)
+
+    def onPropWritten(self, prop, key, result=None):
+        "remember value written by onValue, once the camera call succeeded"
+        self.last_written[prop] = key
 
     def onValue(self, prop=None, value=None,  **kws):
         if self.__initializing:
             return
-        if prop in ('wb_red', 'wb_blue', 'wb_auto'):
+        if prop in WB_WIDGETS:
             prop = 'white_balance'
         if prop == 'autosave_time':
             self.image_panel.datapush_delay = float(value)
         try:
-            if prop in ('shutter', 'gain', 'gamma'): # , 'brightness'):
+            # skip writing values that are unchanged since the last write,
+            # as from losing focus without editing
+            if prop in SCALAR_SET:
                 auto = self.wids['%s_auto' % prop].GetValue()
-                self.camera.SetPropertyValue(prop, float(value), auto=auto)
+                key = (round(float(value), 3), auto)
+                if self.last_written.get(prop, None) == key:
+                    return
+                self.cam_queue.put((self.camera.SetPropertyValue,
+                                    (prop, float(value), auto),
+                                    partial(self.onPropWritten, prop, key)))
             elif prop == 'white_balance':
                 red =  self.wids['wb_red'].GetValue()
                 blue = self.wids['wb_blue'].GetValue()
                 auto = self.wids['wb_auto'].GetValue()
-                self.camera.SetPropertyValue(prop, (red, blue), auto=auto)
-        except:
+                key = (red, blue, auto)
+                if self.last_written.get(prop, None) == key:
+                    return
+                self.cam_queue.put((self.camera.SetPropertyValue,
+                                    (prop, (red, blue), auto),
+                                    partial(self.onPropWritten, prop, key)))
+        except (TypeError, ValueError):
             return
 
 
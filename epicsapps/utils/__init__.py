@@ -4,7 +4,7 @@ from .configfile import (ConfigFile, get_configfolder,
                          get_default_configfile, load_yaml,
                          read_recents_file, write_recents_file)
 
-from .utils import (get_pvtypes, get_pvdesc,
+from .utils import (get_pvtypes, get_pvdesc, get_rectype,
                     normalize_pvname,
                     fix_filename, new_filename,
                     get_timestamp)
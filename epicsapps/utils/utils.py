@@ -76,10 +76,25 @@ def fix_varname(s):
 
 
 def normalize_pvname(pvname):
-    pvname = str(pvname)
-    if '.' not in pvname:
-        pvname = '%s.VAL' % pvname
-    return pvname
+    """return PV name with '.VAL' added if no field is given"""
+    if type(pvname) is not str:
+        pvname = str(pvname)
+    return pvname if '.' in pvname else pvname + '.VAL'
+
+_RTYP_CACHE = {}
+
+def get_rectype(prefix, cache=None):
+    """return record type for a PV prefix, caching the result
+    to avoid repeated Channel Access lookups of '.RTYP'
+    """
+    if cache is None:
+        cache = _RTYP_CACHE
+    rectype = cache.get(prefix, None)
+    if rectype is None:
+        rectype = epics.caget(f"{prefix}.RTYP")
+        if rectype is not None:
+            cache[prefix] = rectype
+    return rectype
 
 def get_pvtypes(pvobj, instrument=None):
     """create tuple of choices for PV Type for database,
@@ -102,7 +117,7 @@ def get_pvtypes(pvobj, instrument=None):
         typename = pvobj.type
         if '.' in prefix:
             prefix, suffix = prefix.split('.')
-        rectype = epics.caget("%s.RTYP" % prefix)
+        rectype = get_rectype(prefix)
         if rectype == 'motor' and suffix in (None, 'VAL'):
             typename = 'motor'
         if pvobj.type == 'char' and pvobj.count > 1: